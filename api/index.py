@@ -2,14 +2,20 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import subprocess
+import asyncio
+import atexit
+import base64
+import binascii
+import contextlib
 import os
 import shutil
+import string
+import secrets
+import time
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
-from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 from urllib.parse import quote
 
@@ -45,21 +51,61 @@ def get_cookies() -> str:
         raise ValueError("COOKIES environment variable not set")
     return cookie_content
 
+def _load_cookie_bytes():
+    """Decode COOKIES_B64 or COOKIES from the environment into cookie file bytes"""
+    load_dotenv()
+    b64_content = os.getenv('COOKIES_B64')
+    if b64_content:
+        try:
+            return base64.b64decode(b64_content, validate=True)
+        except (binascii.Error, ValueError) as e:
+            logger.error(f"Invalid COOKIES_B64 environment variable: {str(e)}")
+            return None
+    env_content = os.getenv('COOKIES')
+    if not env_content:
+        return None
+    return env_content.strip('"').replace('\\n', '\n').encode()
+
+# Cookies never change during the process lifetime, so decode them once
+_COOKIE_BYTES = _load_cookie_bytes()
+
+def write_cookies(output_file: str) -> None:
+    """Atomically write the cached cookie bytes to a private cookie file"""
+    if _COOKIE_BYTES is None:
+        raise ValueError("COOKIES not found in environment variables")
+    # mkstemp creates a fresh 0o600 file, so readers never see a partial write
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_file) or ".")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_COOKIE_BYTES)
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 def env_to_cookies_from_env(output_file: str) -> None:
     """Convert environment variable from .env file to cookie file"""
     try:
-        load_dotenv()
-        env_content = os.getenv('COOKIES')
-        logger.info("Retrieved cookies from environment variable")
-        
-        if not env_content:
-            raise ValueError("COOKIES not found in environment variables")
-            
-        env_to_cookies(f'COOKIES="{env_content}"', output_file)
+        write_cookies(output_file)
+        logger.info(f"Successfully created cookie file at {output_file}")
     except Exception as e:
         logger.error(f"Error creating cookie file from env: {str(e)}")
         raise ValueError(f"Error converting to cookie file: {str(e)}")
 
+def _scanwalk(top: str, dirs_seen: Optional[List[str]] = None):
+    """Recursively yield the non-directory entries under top
+
+    Subdirectory paths are appended to dirs_seen in post-order, if given.
+    """
+    with os.scandir(top) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scanwalk(entry.path, dirs_seen)
+                if dirs_seen is not None:
+                    dirs_seen.append(entry.path)
+            else:
+                yield entry
+
 app = FastAPI(
     title="GAMDL API",
     description="API for downloading Google Drive files using gamdl",
@@ -70,25 +116,38 @@ app = FastAPI(
 DOWNLOADS_DIR = "downloads"
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 
-# Mount the downloads directory
-app.mount("/files", StaticFiles(directory=DOWNLOADS_DIR), name="files")
-
-
+# Public base URL used when building download links
+SPACE_URL = os.getenv("SPACE_URL", "https://tecuts-testing.hf.space")
 
+# Characters quote() leaves untouched, so names made only of these need no encoding
+_URL_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + "_.-~/")
 
-# [Previous cookie handling code remains the same...]
+# Mount the downloads directory
+app.mount("/files", StaticFiles(directory=DOWNLOADS_DIR), name="files")
 
+# Private directory for cookie files, kept outside the served directory
+COOKIE_DIR = tempfile.mkdtemp(prefix="gamdl_cookies_")
+atexit.register(shutil.rmtree, COOKIE_DIR, ignore_errors=True)
 
+# Shared cookie file handed to every gamdl run
+MASTER_COOKIE = os.path.join(COOKIE_DIR, "cookies.txt")
 
+def _write_master_cookies() -> None:
+    """Materialize the shared cookie file"""
+    # Recreate the private directory in case tmp cleaning removed it
+    os.makedirs(COOKIE_DIR, mode=0o700, exist_ok=True)
+    write_cookies(MASTER_COOKIE)
+    logger.info(f"Successfully created cookie file at {MASTER_COOKIE}")
 
-# [Previous cookie handling code remains the same...]
+@app.on_event("startup")
+async def startup():
+    try:
+        _write_master_cookies()
+    except (ValueError, OSError) as e:
+        logger.error(f"Error creating cookie file: {str(e)}")
 
 class DownloadRequest(BaseModel):
     url: str
-    
-
-
-# [Previous cookie handling code remains the same...]
 
 class FileInfo(BaseModel):
     filename: str
@@ -100,100 +159,174 @@ class DownloadResponse(BaseModel):
     message: str
     files: List[FileInfo]
 
+# Cap how many gamdl processes may run at once
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))
+if MAX_CONCURRENT_DOWNLOADS < 1:
+    logger.warning(
+        f"MAX_CONCURRENT_DOWNLOADS={MAX_CONCURRENT_DOWNLOADS} is below 1, using 1"
+    )
+    MAX_CONCURRENT_DOWNLOADS = 1
+
+# Created inside the serving loop; on Python < 3.10 a semaphore binds to the
+# loop that exists when it is constructed
+_download_sem: Optional[asyncio.Semaphore] = None
+
+def get_download_sem() -> asyncio.Semaphore:
+    """Return the download semaphore, creating it in the running loop"""
+    global _download_sem
+    if _download_sem is None:
+        _download_sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    return _download_sem
+
+# Files left in a download directory that are not part of the download
+_SKIP_FILES = frozenset({"cookies.txt"})
+
+# Bounded pool for blocking filesystem work after a download finishes
+FILE_EXECUTOR = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+
+def collect_downloaded_files(download_subdir: str, timestamp: str) -> List[FileInfo]:
+    """Flatten gamdl's output into download_subdir and describe each file"""
+    # Find all files recursively in the download directory
+    dirs_seen = []
+    all_files = [
+        entry for entry in _scanwalk(download_subdir, dirs_seen)
+        if entry.name not in _SKIP_FILES
+    ]
+    
+    logger.info(f"All files found: {[entry.path for entry in all_files]}")
+    
+    if not all_files:
+        raise Exception("No files found after download attempt")
+    
+    # Process all downloaded files
+    downloaded_files = []
+    
+    for entry in all_files:
+        try:
+            filename = entry.name
+            
+            # Create new path at the top of the download directory
+            new_path = os.path.join(download_subdir, filename)
+            
+            logger.info(f"Moving file from {entry.path} to {new_path}")
+            
+            # Rename in place, falling back to a copy across filesystems
+            try:
+                os.rename(entry.path, new_path)
+            except OSError:
+                shutil.move(entry.path, new_path)
+            
+            # Get file extension
+            head, sep, ext = filename.rpartition('.')
+            file_type = ext if sep and head.lstrip('.') else ''
+            
+            # Generate download URL
+            if _URL_SAFE_CHARS.issuperset(filename):
+                encoded_filename = filename
+            else:
+                encoded_filename = quote(filename)
+            download_url = f"{SPACE_URL}/files/{timestamp}/{encoded_filename}"
+            
+            downloaded_files.append(FileInfo(
+                filename=filename,
+                download_url=download_url,
+                file_type=file_type
+            ))
+            
+            logger.info(f"Processed file: {filename} -> {download_url}")
+            
+        except Exception as e:
+            logger.error(f"Error processing file {entry.path}: {str(e)}")
+            continue
+    
+    # Clean up the now-empty gamdl output directories, deepest first
+    for dir_path in dirs_seen:
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass
+    
+    # Files that failed to move still need the full recursive removal
+    music_dir = os.path.join(download_subdir, "Apple Music")
+    if os.path.isdir(music_dir):
+        shutil.rmtree(music_dir, ignore_errors=True)
+    
+    return downloaded_files
+
+# Downloads currently running, keyed by URL, so duplicate requests can share them
+_inflight: Dict[str, asyncio.Future] = {}
+
+def _forget_download(url: str, task: asyncio.Future) -> None:
+    """Drop a finished download from _inflight"""
+    if _inflight.get(url) is task:
+        del _inflight[url]
+    # Retrieve the exception in case every waiting request has gone away
+    if not task.cancelled():
+        task.exception()
+
 @app.post("/download", response_model=DownloadResponse)
 async def download_file(request: DownloadRequest):
+    # The download runs in its own task so no single caller can cancel it
+    task = _inflight.get(request.url)
+    if task is None:
+        task = asyncio.ensure_future(run_download(request.url))
+        _inflight[request.url] = task
+        task.add_done_callback(lambda t: _forget_download(request.url, t))
+    else:
+        logger.info(f"Joining in-flight download for {request.url}")
+    return await asyncio.shield(task)
+
+async def run_download(url: str) -> DownloadResponse:
     try:
         # Create a unique subdirectory for this download
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        download_subdir = os.path.join(DOWNLOADS_DIR, timestamp)
+        timestamp = f"{time.time_ns()}_{secrets.token_hex(4)}"
+        download_subdir = os.path.abspath(os.path.join(DOWNLOADS_DIR, timestamp))
         os.makedirs(download_subdir, exist_ok=True)
         
-        logger.info(f"Current working directory: {os.getcwd()}")
         logger.info(f"Download directory: {download_subdir}")
         
-        # Create cookies file from environment variable
-        cookie_path = os.path.join(download_subdir, "cookies.txt")
-        logger.info(f"Creating cookies file at: {cookie_path}")
-        env_to_cookies_from_env(cookie_path)
+        # Recreate the shared cookies file if it is missing
+        loop = asyncio.get_running_loop()
+        if not os.path.exists(MASTER_COOKIE):
+            await loop.run_in_executor(FILE_EXECUTOR, _write_master_cookies)
         
-        # Change to download directory
-        original_dir = os.getcwd()
-        os.chdir(download_subdir)
-        
-        # Run gamdl command
-        cmd = ["gamdl", "--codec-song", "aac-legacy", request.url]
+        # Run gamdl command inside the download directory
+        cmd = [
+            "gamdl",
+            "--cookies-path", MASTER_COOKIE,
+            "--codec-song", "aac-legacy",
+            url
+        ]
         logger.info(f"Executing command: {' '.join(cmd)}")
         
-        process = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True
-        )
-        
-        logger.info(f"Command stdout: {process.stdout}")
-        logger.info(f"Command stderr: {process.stderr}")
-        
-        process.check_returncode()
-        
-        # Find all files recursively in the download directory
-        all_files = []
-        for root, dirs, files in os.walk('.'):
-            for file in files:
-                if file != "cookies.txt":
-                    file_path = os.path.join(root, file)
-                    all_files.append(file_path)
-        
-        logger.info(f"All files found: {all_files}")
-        
-        if not all_files:
-            raise Exception("No files found after download attempt")
-        
-        # Process all downloaded files
-        downloaded_files = []
-        space_url = os.getenv("SPACE_URL", "https://tecuts-testing.hf.space")
-        
-        for file_path in all_files:
+        async with get_download_sem():
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=download_subdir
+            )
             try:
-                # Get just the filename from the path
-                filename = os.path.basename(file_path)
-                
-                # Create new path in current directory
-                new_path = os.path.join(".", filename)
-                
-                logger.info(f"Moving file from {file_path} to {new_path}")
-                
-                # Copy file to current directory
-                shutil.copy2(file_path, new_path)
-                
-                # Get file extension
-                file_type = os.path.splitext(filename)[1].lstrip('.')
-                
-                # Generate download URL
-                encoded_filename = quote(filename)
-                download_url = f"{space_url}/files/{timestamp}/{encoded_filename}"
-                
-                downloaded_files.append(FileInfo(
-                    filename=filename,
-                    download_url=download_url,
-                    file_type=file_type
-                ))
-                
-                logger.info(f"Processed file: {filename} -> {download_url}")
-                
-            except Exception as e:
-                logger.error(f"Error processing file {file_path}: {str(e)}")
-                continue
+                _, stderr = await proc.communicate()
+            except asyncio.CancelledError:
+                # Don't leave gamdl running outside the concurrency cap
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
+                await proc.wait()
+                raise
         
-        # Clean up original files and directories after successful copy
-        for root, dirs, files in os.walk('.'):
-            for dir_name in dirs:
-                if dir_name == "Apple Music":  # Only remove the music directory
-                    dir_path = os.path.join(root, dir_name)
-                    logger.info(f"Removing directory: {dir_path}")
-                    shutil.rmtree(dir_path, ignore_errors=True)
+        if proc.returncode != 0:
+            stderr = stderr.decode('utf-8', 'replace')
+            logger.error(f"Download process failed: stderr={stderr}")
+            raise HTTPException(
+                status_code=400,
+                detail=f"Failed to download: {stderr or f'gamdl exited with code {proc.returncode}'}"
+            )
         
-        # Move back to original directory
-        os.chdir(original_dir)
+        # Move the downloaded files off the event loop
+        downloaded_files = await loop.run_in_executor(
+            FILE_EXECUTOR, collect_downloaded_files, download_subdir, timestamp
+        )
         
         if not downloaded_files:
             raise Exception("Failed to process any files")
@@ -204,43 +337,59 @@ async def download_file(request: DownloadRequest):
             files=downloaded_files
         )
             
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Download process failed: stdout={e.stdout}, stderr={e.stderr}")
-        raise HTTPException(
-            status_code=400,
-            detail=f"Failed to download: {e.stderr or e.stdout or str(e)}"
-        )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}", exc_info=True)
         raise HTTPException(
             status_code=500,
             detail=f"Error: {str(e)}"
         )
-    finally:
-        if 'original_dir' in locals():
-            os.chdir(original_dir)
             
 @app.get("/")
 async def root():
     return {"message": "Welcome to testing API. Visit /docs for API documentation."}
 
+@app.get("/metrics")
+async def metrics():
+    """Report download slot usage for sizing MAX_CONCURRENT_DOWNLOADS"""
+    available = get_download_sem()._value
+    return {
+        "max_concurrent_downloads": MAX_CONCURRENT_DOWNLOADS,
+        "available_download_slots": available,
+        "active_downloads": MAX_CONCURRENT_DOWNLOADS - available
+    }
+
 @app.get("/test")
 async def test():
     """Test endpoint to verify setup"""
     try:
-        # Test cookie creation
-        temp_cookie = os.path.join(DOWNLOADS_DIR, "test_cookies.txt")
-        env_to_cookies_from_env(temp_cookie)
+        # Test cookie creation in a throwaway file
+        os.makedirs(COOKIE_DIR, mode=0o700, exist_ok=True)
+        fd, temp_cookie = tempfile.mkstemp(dir=COOKIE_DIR)
+        os.close(fd)
+        try:
+            env_to_cookies_from_env(temp_cookie)
+            cookies_size = os.path.getsize(temp_cookie)
+        finally:
+            os.unlink(temp_cookie)
         
         # Test gamdl installation
-        process = subprocess.run(["gamdl", "--version"], capture_output=True, text=True)
+        proc = await asyncio.create_subprocess_exec(
+            "gamdl", "--version",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await proc.communicate()
+        stdout = stdout.decode(errors="replace")
+        stderr = stderr.decode(errors="replace")
         
         return {
-            "gamdl_version": process.stdout.strip(),
-            "cookies_created": os.path.exists(temp_cookie),
-            "cookies_size": os.path.getsize(temp_cookie) if os.path.exists(temp_cookie) else 0,
+            "gamdl_version": stdout.strip(),
+            "cookies_created": True,
+            "cookies_size": cookies_size,
             "installed": True,
-            "error": process.stderr if process.stderr else None
+            "error": stderr if stderr else None
         }
     except Exception as e:
         return {